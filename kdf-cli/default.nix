@@ -59,11 +59,6 @@ let
         wrapProgram $out/bin/kdf \
           --prefix PATH : ${
             lib.makeBinPath [
-              pkgs.coreutils
-              pkgs.xz
-              pkgs.gzip
-              pkgs.cpio
-              pkgs.findutils
               pkgs.kmod
             ]
           }
@@ -99,11 +94,6 @@ in
         lib.makeBinPath [
           pkgs.qemu
           pkgs.virtiofsd
-          pkgs.coreutils
-          pkgs.xz
-          pkgs.gzip
-          pkgs.cpio
-          pkgs.findutils
           pkgs.kmod
         ]
       } \
@@ -11,6 +11,9 @@ if TYPE_CHECKING:
 class BackgroundTask(ABC):
     """Abstract base class for background tasks."""
 
+    # Let subclasses opt into __slots__ without gaining a __dict__
+    __slots__ = ()
+
     @abstractmethod
     def start(self) -> None:
         """Start the background task."""
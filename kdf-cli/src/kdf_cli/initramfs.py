@@ -1,13 +1,35 @@
 """Initramfs building utilities."""
 
+import contextlib
+import gzip
+import hashlib
 import logging
+import lzma
 import os
+import shutil
+import stat
 import subprocess
 import tempfile
-from pathlib import Path
+from collections import defaultdict, deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO
+
+from kdf_cli.process import run_command
 
 logger = logging.getLogger("kdf.initramfs")
 
+# Write buffer size for initramfs archives
+COPY_BUFSIZE = 1 << 20
+
+# newc ("new ASCII") cpio format, as expected by the kernel's initramfs unpacker
+CPIO_NEWC_MAGIC = "070701"
+CPIO_TRAILER = "TRAILER!!!"
+
+# Number of initramfs archives kept in the cache (least recently used first out)
+INITRAMFS_CACHE_ENTRIES = 8
+
 
 def get_resource_dir() -> Path | None:
     """Get resource directory if running from Nix package, None otherwise."""
@@ -37,67 +59,251 @@ def get_prebuilt_init() -> Path | None:
     return None
 
 
+def get_cache_dir() -> Path:
+    """Get the kdf cache directory, creating it if needed."""
+    cache_home = os.environ.get("XDG_CACHE_HOME")
+    base = Path(cache_home) if cache_home else Path.home() / ".cache"
+    cache_dir = base / "kdf"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def hash_file(path: Path) -> str:
+    """Return the hex SHA-256 digest of a file."""
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _temp_path_for(path: Path) -> Path:
+    """Get a fresh temporary path next to path, to write and rename over it.
+
+    Replacing path instead of writing to it never modifies an existing inode
+    that path may share with another file (e.g. a hard link into the store).
+    """
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp_path.unlink(missing_ok=True)
+    return tmp_path
+
+
 def copy_file(src: Path, dst: Path) -> None:
-    """Copy file from src to dst."""
-    subprocess.run(["cp", str(src), str(dst)], check=True)
+    """Copy file from src to dst, replacing rather than overwriting dst."""
+    tmp_path = _temp_path_for(dst)
+    try:
+        # copyfile uses copy_file_range/sendfile on Linux, no need to spawn cp
+        shutil.copyfile(src, tmp_path)
+        tmp_path.replace(dst)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _strip_module_suffixes(name: str) -> str:
+    """Turn a module file name (e.g. virtio-pci.ko.xz) into its module name.
+
+    The kernel reports module names with dashes replaced by underscores, so
+    normalize the same way to match names from modinfo's depends field.
+    """
+    name = name.removesuffix(".xz").removesuffix(".gz").removesuffix(".ko")
+    return name.replace("-", "_")
+
+
+def _parse_depends(value: str) -> list[str]:
+    """Parse a comma-separated modinfo depends value into module names."""
+    return [_strip_module_suffixes(d.strip()) for d in value.split(",") if d.strip()]
 
 
 def get_module_dependencies(module_path: Path) -> list[str]:
     """Get module dependencies using modinfo."""
     try:
-        result = subprocess.run(
-            ["modinfo", "-F", "depends", str(module_path)],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-        deps = result.stdout.strip()
-        if deps:
-            return [d.strip() for d in deps.split(",") if d.strip()]
-        return []
+        result = run_command(["modinfo", "-F", "depends", str(module_path)])
+        return _parse_depends(result.stdout.strip())
     except subprocess.CalledProcessError:
         return []
 
 
+def get_all_module_dependencies(modules: list[Path]) -> dict[Path, list[str]]:
+    """Get dependencies for all modules with a single modinfo invocation.
+
+    modinfo prints one depends line per file in input order. If the output
+    cannot be matched up with the input (e.g. a module failed to parse), fall
+    back to querying each module individually.
+    """
+    if not modules:
+        return {}
+
+    result = run_command(["modinfo", "-F", "depends", *map(str, modules)], check=False)
+    lines = result.stdout.splitlines()
+    if result.returncode != 0 or len(lines) != len(modules):
+        logger.debug("Batched modinfo output unusable, querying modules one by one")
+        return {module: get_module_dependencies(module) for module in modules}
+
+    return {
+        module: _parse_depends(line)
+        for module, line in zip(modules, lines, strict=True)
+    }
+
+
 def topological_sort_modules(modules: list[Path]) -> list[Path]:
-    """Sort modules in dependency order using topological sort."""
+    """Sort modules in dependency order using topological sort.
+
+    Raises:
+        ValueError: If the module dependencies contain a cycle
+
+    """
     # Build dependency graph
-    module_map = {}  # name (without .ko.xz) -> Path
-    dependencies = {}  # name -> list of dependency names
+    names = [_strip_module_suffixes(module_path.name) for module_path in modules]
+    module_map = dict(zip(names, modules, strict=True))  # module name -> Path
+    module_deps = get_all_module_dependencies(modules)
+    # name -> list of dependency names
+    dependencies = {
+        name: module_deps[module_path] for name, module_path in module_map.items()
+    }
+
+    # Topological sort (Kahn's algorithm): reverse edges map each dependency to
+    # the modules that need it, so every edge is visited exactly once
+    reverse: defaultdict[str, list[str]] = defaultdict(list)
+    in_degree = dict.fromkeys(module_map, 0)
+    for name, deps in dependencies.items():
+        for dep in deps:
+            if dep in module_map:  # Only if we have this dependency
+                reverse[dep].append(name)
+                in_degree[name] += 1
 
+    sorted_modules = []
+    queue = deque(name for name, degree in in_degree.items() if degree == 0)
+    while queue:
+        name = queue.popleft()
+        sorted_modules.append(module_map[name])
+        for dependent in reverse[name]:
+            in_degree[dependent] -= 1
+            if in_degree[dependent] == 0:
+                queue.append(dependent)
+
+    # Modules never reaching in-degree 0 are in (or depend on) a cycle
+    if len(sorted_modules) != len(module_map):
+        cycle = sorted(name for name, degree in in_degree.items() if degree > 0)
+        msg = f"Module dependency cycle detected among: {cycle}"
+        raise ValueError(msg)
+
+    return sorted_modules
+
+
+def find_missing_modules(modules: list[Path]) -> list[Path]:
+    """Return the modules that do not exist.
+
+    Modules usually share a few directories, so list each directory once
+    instead of stat-ing every module.
+    """
+    by_parent: defaultdict[Path, list[Path]] = defaultdict(list)
     for module_path in modules:
-        name = module_path.name
-        # Remove compression extensions
-        name = name.removesuffix(".xz")
-        name = name.removesuffix(".gz")
-        # Remove .ko extension
-        name = name.removesuffix(".ko")
+        by_parent[module_path.parent].append(module_path)
 
-        module_map[name] = module_path
-        dependencies[name] = get_module_dependencies(module_path)
+    missing = []
+    for parent, parent_modules in by_parent.items():
+        try:
+            with os.scandir(parent) as it:
+                existing = {entry.name for entry in it}
+        except (FileNotFoundError, NotADirectoryError):
+            existing = set()
+        missing.extend(m for m in parent_modules if m.name not in existing)
+    return missing
 
-    # Topological sort
-    sorted_modules = []
-    visited = set()
 
-    def visit(name: str) -> None:
-        if name in visited:
-            return
-        visited.add(name)
+def read_module(module_path: Path) -> bytes:
+    """Read a kernel module, decompressing .xz/.gz modules."""
+    data = module_path.read_bytes()
+    if module_path.name.endswith(".xz"):
+        return lzma.decompress(data)
+    if module_path.name.endswith(".gz"):
+        return gzip.decompress(data)
+    return data
 
-        # Visit dependencies first
-        for dep in dependencies.get(name, []):
-            if dep in module_map:  # Only if we have this dependency
-                visit(dep)
 
-        if name in module_map:
-            sorted_modules.append(module_map[name])
+def _pad4(length: int) -> bytes:
+    """Return the NUL padding needed to align length to 4 bytes."""
+    return b"\0" * (-length % 4)
 
-    # Visit all modules
-    for name in module_map:
-        visit(name)
 
-    return sorted_modules
+def _write_newc_header(
+    out: BinaryIO,
+    name: str,
+    *,
+    ino: int,
+    mode: int,
+    nlink: int,
+    filesize: int,
+) -> None:
+    """Write a newc header followed by the padded entry name."""
+    encoded_name = name.encode() + b"\0"
+    # ino, mode, uid, gid, nlink, mtime, filesize, devmajor, devminor,
+    # rdevmajor, rdevminor, namesize, check. Entries are owned by root with a
+    # zero mtime so archives are reproducible.
+    fields = (ino, mode, 0, 0, nlink, 0, filesize, 0, 0, 0, 0, len(encoded_name), 0)
+    header = CPIO_NEWC_MAGIC + "".join(f"{field:08x}" for field in fields)
+    out.write(header.encode() + encoded_name)
+    out.write(_pad4(len(header) + len(encoded_name)))
+
+
+def _write_newc_cpio(entries: Iterable[tuple[str, int, bytes]], out: BinaryIO) -> None:
+    """Write (name, mode, data) entries to out as a newc cpio archive.
+
+    Directories must precede their contents; data is ignored for directories.
+    """
+    for ino, (name, mode, data) in enumerate(entries, 1):
+        if stat.S_ISDIR(mode):
+            _write_newc_header(out, name, ino=ino, mode=mode, nlink=2, filesize=0)
+        else:
+            _write_newc_header(
+                out, name, ino=ino, mode=mode, nlink=1, filesize=len(data)
+            )
+            out.write(data)
+            out.write(_pad4(len(data)))
+
+    _write_newc_header(out, CPIO_TRAILER, ino=0, mode=0, nlink=1, filesize=0)
+
+
+def _initramfs_entries(
+    init_binary: Path,
+    modules: list[Path],
+    moddir: str,
+) -> Iterator[tuple[str, int, bytes]]:
+    """Yield cpio entries for the init binary and kernel modules."""
+    yield "init", stat.S_IFREG | 0o755, init_binary.read_bytes()
+
+    if not modules:
+        return
+
+    missing = find_missing_modules(modules)
+    if missing:
+        msg = f"Kernel module not found: {', '.join(map(str, missing))}"
+        raise FileNotFoundError(msg)
+
+    # Sort modules by dependencies
+    sorted_modules = topological_sort_modules(modules)
+    logger.info("Module load order after dependency resolution:")
+    for idx, mod in enumerate(sorted_modules, 1):
+        logger.info("  %s. %s", idx, mod.name)
+
+    # Create moddir and its parents (without leading slash)
+    moddir_parts = PurePosixPath(moddir.lstrip("/")).parts
+    for depth in range(1, len(moddir_parts) + 1):
+        yield "/".join(moddir_parts[:depth]), stat.S_IFDIR | 0o755, b""
+    moddir_relative = "/".join(moddir_parts)
+
+    # Decompression releases the GIL, so threads run in parallel. map() yields
+    # in load order, so each module is written as soon as it and its
+    # predecessors are ready.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        module_data = executor.map(read_module, sorted_modules)
+        for idx, (module_path, data) in enumerate(
+            zip(sorted_modules, module_data, strict=True)
+        ):
+            # Drop compression extension and add numeric prefix for load order
+            module_name = module_path.name
+            if module_name.endswith((".xz", ".gz")):
+                module_name = module_name[:-3]
+            final_name = f"{idx:02d}-{module_name}"  # Two-digit prefix: 00-, 01-
+            logger.info("Added module: %s -> %s", module_path.name, final_name)
+            yield f"{moddir_relative}/{final_name}", stat.S_IFREG | 0o644, data
 
 
 def create_initramfs_archive(
@@ -106,74 +312,90 @@ def create_initramfs_archive(
     modules: list[Path],
     moddir: str,
 ) -> None:
-    """Create initramfs cpio archive from init binary and optional kernel modules."""
-    with tempfile.TemporaryDirectory() as tmpdir:
-        tmppath = Path(tmpdir)
-
-        # Copy init binary to temp directory
-        init_path = tmppath / "init"
-        copy_file(init_binary, init_path)
-        subprocess.run(["chmod", "+x", str(init_path)], check=True)
-
-        # Copy kernel modules if provided
-        if modules:
-            # Sort modules by dependencies
-            sorted_modules = topological_sort_modules(modules)
-            logger.info("Module load order after dependency resolution:")
-            for idx, mod in enumerate(sorted_modules, 1):
-                logger.info("  %s. %s", idx, mod.name)
-
-            # Strip leading slash for creating directory in tmpdir
-            moddir_relative = moddir.lstrip("/")
-            modules_dir = tmppath / moddir_relative
-            modules_dir.mkdir(parents=True, exist_ok=True)
-
-            for idx, module_path in enumerate(sorted_modules):
-                if not module_path.exists():
-                    msg = f"Kernel module not found: {module_path}"
-                    raise FileNotFoundError(msg)
-
-                # Decompress if needed and add numeric prefix for load order
-                module_name = module_path.name
-                prefix = f"{idx:02d}-"  # Two-digit prefix: 00-, 01-, etc.
-
-                if module_name.endswith(".xz"):
-                    # Decompress .xz module
-                    decompressed_name = module_name[:-3]  # Remove .xz extension
-                    final_name = prefix + decompressed_name
-                    module_dest = modules_dir / final_name
-                    with module_dest.open("wb") as dest_file:
-                        subprocess.run(
-                            ["xz", "-dc", str(module_path)],
-                            stdout=dest_file,
-                            check=True,
-                        )
-                    logger.info("Added module: %s -> %s", module_name, final_name)
-                elif module_name.endswith(".gz"):
-                    # Decompress .gz module
-                    decompressed_name = module_name[:-3]  # Remove .gz extension
-                    final_name = prefix + decompressed_name
-                    module_dest = modules_dir / final_name
-                    with module_dest.open("wb") as dest_file:
-                        subprocess.run(
-                            ["gzip", "-dc", str(module_path)],
-                            stdout=dest_file,
-                            check=True,
-                        )
-                    logger.info("Added module: %s -> %s", module_name, final_name)
-                else:
-                    # Copy as-is
-                    final_name = prefix + module_name
-                    module_dest = modules_dir / final_name
-                    copy_file(module_path, module_dest)
-                    logger.info("Added module: %s -> %s", module_name, final_name)
-
-        # Create cpio archive
-        with output_path.open("wb") as f:
-            subprocess.run(
-                "find . -print0 | cpio --null -o -H newc",
-                cwd=tmpdir,
-                shell=True,
-                stdout=f,
-                check=True,
-            )
+    """Create initramfs cpio archive from init binary and optional kernel modules.
+
+    The archive is written to a temporary file and renamed into place, so
+    output_path is never left truncated and an existing file is replaced
+    rather than written through.
+    """
+    entries = _initramfs_entries(init_binary, modules, moddir)
+    tmp_path = _temp_path_for(output_path)
+    try:
+        with tmp_path.open("xb", buffering=COPY_BUFSIZE) as f:
+            _write_newc_cpio(entries, f)
+        tmp_path.replace(output_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _initramfs_cache_dir() -> Path | None:
+    """Get the initramfs cache directory, or None if it is not writable."""
+    try:
+        cache_dir = get_cache_dir() / "initramfs"
+        cache_dir.mkdir(exist_ok=True)
+    except OSError as e:
+        logger.warning("Initramfs cache unavailable: %s", e)
+        return None
+    if not os.access(cache_dir, os.W_OK):
+        logger.warning("Initramfs cache not writable: %s", cache_dir)
+        return None
+    return cache_dir
+
+
+def _evict_cached_initramfs(cache_dir: Path) -> None:
+    """Remove all but the INITRAMFS_CACHE_ENTRIES most recently used archives."""
+    archives = []
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".cpio"):
+                # Another kdf process may evict the same archive concurrently
+                with contextlib.suppress(FileNotFoundError):
+                    archives.append((entry.stat().st_mtime_ns, entry.path))
+
+    archives.sort(reverse=True)
+    for _, path in archives[INITRAMFS_CACHE_ENTRIES:]:
+        logger.info("Evicting cached initramfs: %s", path)
+        Path(path).unlink(missing_ok=True)
+
+
+def get_cached_initramfs(init_binary: Path, modules: list[Path], moddir: str) -> Path:
+    """Get an initramfs for the given inputs, building it only on a cache miss.
+
+    Archives are stored in $XDG_CACHE_HOME/kdf/initramfs, keyed by the
+    contents of the init binary and modules plus the module directory. Only
+    the INITRAMFS_CACHE_ENTRIES most recently used archives are kept. If the
+    cache directory is not writable, a temporary archive is built instead.
+
+    Returns:
+        Path to the initramfs archive (must not be modified)
+
+    """
+    cache_dir = _initramfs_cache_dir()
+    if cache_dir is None:
+        fd, tmpfile = tempfile.mkstemp(prefix="kdf-initramfs-", suffix=".cpio")
+        os.close(fd)
+        tmp_path = Path(tmpfile)
+        create_initramfs_archive(init_binary, tmp_path, modules, moddir)
+        logger.info("Built temporary initramfs: %s", tmp_path)
+        return tmp_path
+
+    key = hashlib.sha256(hash_file(init_binary).encode())
+    for module_path in sorted(module.resolve() for module in modules):
+        key.update(hash_file(module_path).encode())
+    key.update(moddir.encode())
+
+    cached_path = cache_dir / f"{key.hexdigest()}.cpio"
+    if cached_path.exists():
+        # The modification time records when the archive was last used
+        with contextlib.suppress(OSError):
+            cached_path.touch()
+        logger.info("Using cached initramfs: %s", cached_path)
+        return cached_path
+
+    # Archives are renamed into place, so concurrent or interrupted builds
+    # never leave a partial archive behind
+    create_initramfs_archive(init_binary, cached_path, modules, moddir)
+    logger.info("Cached initramfs: %s", cached_path)
+
+    _evict_cached_initramfs(cache_dir)
+    return cached_path
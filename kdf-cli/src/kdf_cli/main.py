@@ -3,32 +3,42 @@
 
 import argparse
 import logging
-import subprocess
+import os
 import sys
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+# Subcommand dependencies are imported where they are used to keep CLI
+# startup (e.g. kdf --help) fast
+if TYPE_CHECKING:
+    from kdf_cli.qemu import QemuCommand
 
-from kdf_cli.bg_tasks import BackgroundTaskManager
-from kdf_cli.initramfs import (
-    copy_file,
-    create_initramfs_archive,
-    get_prebuilt_init,
-    get_prebuilt_initramfs,
-)
-from kdf_cli.nix import resolve_kernel_and_initramfs
-from kdf_cli.qemu import QemuCommand
-from kdf_cli.virtiofs import VirtiofsError, create_virtiofs_tasks
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("kdf.log"), logging.StreamHandler(sys.stderr)],
-)
 logger = logging.getLogger("kdf")
 
 
+def _setup_logging() -> None:
+    """Configure logging to stderr and a log file (KDF_LOG, default ./kdf.log).
+
+    Called only once a subcommand runs, so e.g. kdf --help does not create
+    the log file.
+    """
+    log_path = os.environ.get("KDF_LOG", "kdf.log")
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        handlers=[logging.FileHandler(log_path), logging.StreamHandler(sys.stderr)],
+    )
+
+
 def cmd_build_initramfs(args: argparse.Namespace) -> None:
     """Build initramfs cpio archive from init binary."""
+    from kdf_cli.initramfs import (
+        copy_file,
+        create_initramfs_archive,
+        get_prebuilt_init,
+        get_prebuilt_initramfs,
+    )
+
     try:
         # Parse module paths if provided
         modules = []
@@ -87,7 +97,11 @@ def _resolve_kernel_and_initramfs(args: argparse.Namespace) -> tuple[Path, Path]
         Tuple of (kernel_path, initramfs_path)
 
     """
+    from kdf_cli.initramfs import get_prebuilt_initramfs
+
     if args.release is not None:
+        from kdf_cli.nix import resolve_kernel_and_initramfs
+
         try:
             kernel, initramfs = resolve_kernel_and_initramfs(
                 version=args.release if args.release else None,
@@ -131,7 +145,7 @@ def _resolve_kernel_and_initramfs(args: argparse.Namespace) -> tuple[Path, Path]
     return kernel, initramfs
 
 
-def _configure_init(args: argparse.Namespace, qemu_cmd: QemuCommand) -> None:
+def _configure_init(args: argparse.Namespace, qemu_cmd: "QemuCommand") -> None:
     """Configure init settings from command-line arguments.
 
     Args:
@@ -158,7 +172,7 @@ def _configure_init(args: argparse.Namespace, qemu_cmd: QemuCommand) -> None:
     # Handle --nix packages for PATH
     if args.nix is not None and args.nix:
         # Parse comma-separated package list
-        package_attrs = [pkg.strip() for pkg in args.nix.split(",") if pkg.strip()]
+        package_attrs = tuple(pkg.strip() for pkg in args.nix.split(",") if pkg.strip())
         if package_attrs:
             from kdf_cli.nix import resolve_nix_packages
 
@@ -185,6 +199,13 @@ def _configure_init(args: argparse.Namespace, qemu_cmd: QemuCommand) -> None:
 
 def cmd_run(args: argparse.Namespace) -> None:
     """Run QEMU with kernel and initramfs."""
+    import subprocess
+
+    from kdf_cli.bg_tasks import BackgroundTaskManager
+    from kdf_cli.process import find_executable
+    from kdf_cli.qemu import QemuCommand
+    from kdf_cli.virtiofs import VirtiofsError, create_virtiofs_tasks
+
     kernel, initramfs = _resolve_kernel_and_initramfs(args)
 
     # Create background task manager
@@ -229,7 +250,14 @@ def cmd_run(args: argparse.Namespace) -> None:
         cmd = qemu_cmd.build()
         logger.info("Running QEMU with command:")
         logger.info(" ".join(cmd))
-        subprocess.run(cmd, check=False)
+        # fds opened by Python are non-inheritable (PEP 446), so skip the
+        # close-all-fds loop; with the resolved executable this also lets
+        # subprocess use posix_spawn
+        subprocess.run(
+            [find_executable(cmd[0]), *cmd[1:]],
+            check=False,
+            close_fds=False,
+        )
     except (ValueError, VirtiofsError) as e:
         logger.exception("Error: %s", e)
         sys.exit(1)
@@ -384,8 +412,10 @@ def main() -> None:
             build_parser.print_help()
             sys.exit(1)
         if args.build_command == "initramfs":
+            _setup_logging()
             cmd_build_initramfs(args)
     elif args.command == "run":
+        _setup_logging()
         cmd_run(args)
 
 
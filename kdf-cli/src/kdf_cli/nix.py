@@ -1,59 +1,223 @@
 """Nix integration for kernel resolution."""
 
+import functools
+import hashlib
+import json
 import logging
+import os
 import subprocess
-import tempfile
+from collections.abc import Iterable
 from pathlib import Path
 
-from kdf_cli.initramfs import create_initramfs_archive, get_prebuilt_init
+from kdf_cli.initramfs import get_cache_dir, get_cached_initramfs, get_prebuilt_init
+from kdf_cli.process import run_command
 
 logger = logging.getLogger("kdf.nix")
 
-# Virtiofs module dependencies
+# Cache of evaluation results (derivation paths, package PATHs), keyed by the
+# nixpkgs store path, nixpkgs configuration and expression
+EVAL_CACHE_FILE = "drv-cache.json"
+
+# Number of evaluation results kept in the cache (oldest first out)
+EVAL_CACHE_ENTRIES = 32
+
+# Environment variable that disables the evaluation cache when set
+NO_EVAL_CACHE_ENV = "KDF_NO_EVAL_CACHE"
+
+# Virtiofs module dependencies as (directory, file name) pairs relative to
+# lib/modules/VERSION/kernel
 # (order doesn't matter - dependency resolution happens during build)
-VIRTIOFS_MODULES = [
-    "drivers/virtio/virtio.ko",
-    "drivers/virtio/virtio_ring.ko",
-    "drivers/virtio/virtio_pci_modern_dev.ko",
-    "drivers/virtio/virtio_pci_legacy_dev.ko",
-    "drivers/virtio/virtio_pci.ko",
-    "fs/fuse/fuse.ko",
-    "fs/fuse/virtiofs.ko",
-]
+VIRTIOFS_MODULES: tuple[tuple[str, str], ...] = (
+    ("drivers/virtio", "virtio.ko"),
+    ("drivers/virtio", "virtio_ring.ko"),
+    ("drivers/virtio", "virtio_pci_modern_dev.ko"),
+    ("drivers/virtio", "virtio_pci_legacy_dev.ko"),
+    ("drivers/virtio", "virtio_pci.ko"),
+    ("fs/fuse", "fuse.ko"),
+    ("fs/fuse", "virtiofs.ko"),
+)
 
 
 def get_system_kernel_version() -> str:
-    """Get the current system kernel version using uname."""
-    result = subprocess.run(["uname", "-r"], capture_output=True, text=True, check=True)
-    return result.stdout.strip()
+    """Get the current system kernel version (as reported by uname -r)."""
+    return os.uname().release
+
+
+@functools.cache
+def _nixpkgs_store_path() -> Path | None:
+    """Resolve <nixpkgs> to a store path, once per process.
+
+    Resolving <nixpkgs> does not evaluate it, so this is cheap. Returns None
+    if <nixpkgs> is not an (immutable) store path, e.g. a local checkout.
+    """
+    try:
+        result = run_command(["nix-instantiate", "--find-file", "nixpkgs"])
+    except subprocess.CalledProcessError:
+        return None
+
+    # Channels are symlinks into the store
+    nixpkgs = Path(result.stdout.strip()).resolve()
+    if not nixpkgs.is_relative_to("/nix/store"):
+        return None
+    return nixpkgs
+
+
+def _nixpkgs_config_files() -> list[Path]:
+    """List the files `import <nixpkgs> {}` reads its config and overlays from."""
+    config_home = os.environ.get("XDG_CONFIG_HOME")
+    base = Path(config_home) if config_home else Path.home() / ".config"
+    config_dir = base / "nixpkgs"
+
+    nixpkgs_config = os.environ.get("NIXPKGS_CONFIG")
+    files = [Path(nixpkgs_config)] if nixpkgs_config else []
+    files += [
+        config_dir / "config.nix",
+        Path.home() / ".nixpkgs" / "config.nix",
+        config_dir / "overlays.nix",
+    ]
+    overlays_dir = config_dir / "overlays"
+    if overlays_dir.is_dir():
+        files += sorted(p for p in overlays_dir.rglob("*") if p.is_file())
+    return files
+
+
+@functools.cache
+def _nixpkgs_config_fingerprint() -> str:
+    """Hash the inputs besides <nixpkgs> that `import <nixpkgs> {}` depends on.
+
+    Covers the system type, NIX_PATH (which may point at overlays), the
+    NIXPKGS_* environment and the contents of the config and overlay files.
+    Files those import are not tracked; set KDF_NO_EVAL_CACHE to bypass the
+    cache after changing them.
+    """
+    uname = os.uname()
+    key = hashlib.sha256(f"{uname.machine}-{uname.sysname}".encode())
+    for name, value in sorted(os.environ.items()):
+        if name == "NIX_PATH" or name.startswith("NIXPKGS_"):
+            key.update(f"\0{name}={value}".encode())
+    for path in _nixpkgs_config_files():
+        key.update(f"\0{path}\0".encode())
+        try:
+            key.update(path.read_bytes())
+        except OSError:
+            key.update(b"\0missing")
+    return key.hexdigest()
+
+
+def _nixpkgs_cache_key(nix_expr: str) -> str | None:
+    """Get an evaluation cache key for nix_expr.
+
+    Returns None if the cache is disabled with KDF_NO_EVAL_CACHE or
+    <nixpkgs> is not a store path, since evaluation results of a mutable
+    nixpkgs may change at any time.
+    """
+    if os.environ.get(NO_EVAL_CACHE_ENV):
+        return None
+    nixpkgs = _nixpkgs_store_path()
+    if nixpkgs is None:
+        return None
+    return f"{nixpkgs}\n{_nixpkgs_config_fingerprint()}\n{nix_expr}"
+
+
+def _load_eval_cache() -> dict[str, list[str]]:
+    """Load the evaluation cache (empty if missing or unreadable)."""
+    try:
+        return json.loads((get_cache_dir() / EVAL_CACHE_FILE).read_text())
+    except (OSError, ValueError):
+        return {}
+
 
+def _get_cached_eval(key: str | None) -> list[str] | None:
+    """Get a cached evaluation result."""
+    if key is None:
+        return None
+    return _load_eval_cache().get(key)
 
-def nix_build_output(nix_expr: str, output: str | None = None) -> str:
-    """Build a Nix expression and return the output path.
+
+def _store_cached_eval(key: str | None, value: list[str]) -> None:
+    """Store an evaluation result, ignoring errors writing the cache.
+
+    Results for other nixpkgs revisions or configurations can no longer be
+    hit and are dropped, as are the oldest results beyond EVAL_CACHE_ENTRIES.
+    """
+    if key is None:
+        return
+    try:
+        cache_path = get_cache_dir() / EVAL_CACHE_FILE
+        # Keys are "<nixpkgs>\n<config fingerprint>\n<expression>"
+        nixpkgs, fingerprint, _ = key.split("\n", 2)
+        prefix = f"{nixpkgs}\n{fingerprint}\n"
+        cache = {k: v for k, v in _load_eval_cache().items() if k.startswith(prefix)}
+        # Re-insert so dict order is oldest to newest store
+        cache.pop(key, None)
+        cache[key] = value
+        cache = dict(list(cache.items())[-EVAL_CACHE_ENTRIES:])
+        # Write and rename so concurrent readers never see a partial file
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(cache))
+        tmp_path.replace(cache_path)
+    except OSError as e:
+        logger.warning("Failed to write evaluation cache: %s", e)
+
+
+def nix_build(nix_expr: str) -> list[str]:
+    """Build a Nix expression and return the output paths.
+
+    The derivations nix_expr instantiates to are cached, so repeated builds
+    skip evaluating nixpkgs and only realise the cached derivations.
 
     Args:
-        nix_expr: Nix expression to build
-        output: Optional output name (e.g., "modules", "dev").
-            If None, uses default output.
+        nix_expr: Nix expression to build. May evaluate to a list, in which
+            case all elements are built with a single evaluation.
 
     Returns:
-        Nix store path as a string
+        Nix store paths, one per built output
 
     """
-    full_expr = f"({nix_expr}).{output}" if output else nix_expr
+    key = _nixpkgs_cache_key(nix_expr)
+    drv_paths = _get_cached_eval(key)
+    if drv_paths is not None:
+        try:
+            return nix_realise(drv_paths)
+        except subprocess.CalledProcessError:
+            # Cached derivations are not GC roots and may have been collected
+            logger.info("Cached derivations unavailable, re-evaluating")
+
+    result = run_command(["nix-instantiate", "-E", nix_expr])
+    # nix-instantiate prints a bare drv path for the default output, but
+    # realising a bare drv path builds and prints all of its outputs
+    drv_paths = [f"{p}!out" if p.endswith(".drv") else p for p in result.stdout.split()]
+    _store_cached_eval(key, drv_paths)
+    return nix_realise(drv_paths)
+
+
+def nix_realise(drv_paths: list[str]) -> list[str]:
+    """Realise derivations and return the output paths.
+
+    Pass drv!output paths to get exactly one output path per argument; a bare
+    drv path realises (and returns) every output of the derivation.
+    """
+    result = run_command(["nix-store", "--realise", *drv_paths])
+    return result.stdout.split()
 
-    result = subprocess.run(
-        ["nix-build", "--no-out-link", "-E", full_expr],
-        capture_output=True,
-        text=True,
-        check=True,
-    )
-    return result.stdout.strip()
+
+def _split_kernel_outputs(output_paths: list[str]) -> tuple[str, str]:
+    """Split built kernel output paths into (kernel, modules) store paths."""
+    # Non-default outputs are named <name>-<output> in the store
+    modules = [p for p in output_paths if p.endswith("-modules")]
+    kernel = [p for p in output_paths if not p.endswith("-modules")]
+    if len(modules) != 1 or len(kernel) != 1:
+        msg = f"Unexpected kernel build outputs: {output_paths}"
+        raise ValueError(msg)
+    return kernel[0], modules[0]
 
 
+@functools.cache
 def get_kernel_derivations(version: str | None = None) -> tuple[str, str]:
     """Get the Nix store paths for kernel and modules derivations.
 
+    Results are memoized for the lifetime of the process.
+
     Args:
         version: Kernel version string (e.g., "6.6" or "6.12")
             or None for default kernel
@@ -64,7 +228,7 @@ def get_kernel_derivations(version: str | None = None) -> tuple[str, str]:
     """
     if version is None or version == "":
         # Use default linuxPackages
-        nix_expr = "with import <nixpkgs> {}; linuxPackages.kernel"
+        package_name = "linuxPackages"
         logger.info("Using default linuxPackages kernel")
     else:
         # Parse version to get major.minor
@@ -83,25 +247,28 @@ def get_kernel_derivations(version: str | None = None) -> tuple[str, str]:
 
         # Use linuxPackages_{major}_{minor}
         package_name = f"linuxPackages_{major}_{minor}"
-        nix_expr = f"with import <nixpkgs> {{}}; {package_name}.kernel"
         logger.info("Using %s from nixpkgs", package_name)
 
-    try:
-        # Build kernel (default output)
-        kernel_drv = nix_build_output(nix_expr)
-
-        # Build modules output
-        modules_drv = nix_build_output(nix_expr, "modules")
-
-        logger.info("Kernel derivation: %s", kernel_drv)
-        logger.info("Modules derivation: %s", modules_drv)
-
-        return kernel_drv, modules_drv
+    # Build kernel and modules outputs in one invocation so nixpkgs is only
+    # evaluated once
+    nix_expr = (
+        f"with import <nixpkgs> {{}}; "
+        f"let kernel = {package_name}.kernel; in [ kernel kernel.modules ]"
+    )
 
+    try:
+        output_paths = nix_build(nix_expr)
     except subprocess.CalledProcessError as e:
         logger.exception("Failed to resolve kernel: %s", e.stderr)
         raise
 
+    kernel_drv, modules_drv = _split_kernel_outputs(output_paths)
+
+    logger.info("Kernel derivation: %s", kernel_drv)
+    logger.info("Modules derivation: %s", modules_drv)
+
+    return kernel_drv, modules_drv
+
 
 def get_kernel_image_path(kernel_drv: str) -> Path:
     """Get the path to the kernel image (bzImage) from the kernel derivation.
@@ -115,10 +282,17 @@ def get_kernel_image_path(kernel_drv: str) -> Path:
     """
     kernel_path = Path(kernel_drv)
 
+    # List the output once instead of stat-ing every candidate
+    try:
+        with os.scandir(kernel_path) as it:
+            names = {entry.name for entry in it}
+    except FileNotFoundError:
+        names = set()
+
     # Try common kernel image names
-    for image_name in ["bzImage", "Image", "vmlinuz", "zImage"]:
-        kernel_image = kernel_path / image_name
-        if kernel_image.exists():
+    for image_name in ("bzImage", "Image", "vmlinuz", "zImage"):
+        if image_name in names:
+            kernel_image = kernel_path / image_name
             logger.info("Found kernel image: %s", kernel_image)
             return kernel_image
 
@@ -126,54 +300,76 @@ def get_kernel_image_path(kernel_drv: str) -> Path:
     raise FileNotFoundError(msg)
 
 
-def find_modules(modules_drv: str, module_patterns: list[str]) -> list[Path]:
+@functools.lru_cache(maxsize=16)
+def _kernel_base(modules_drv: str) -> Path:
+    """Get the lib/modules/VERSION/kernel directory of a modules derivation."""
+    # Find the kernel version directory (only the first one is used)
+    modules_dir = Path(modules_drv) / "lib" / "modules"
+    with os.scandir(modules_dir) as it:
+        kernel_dir = next(it, None)
+    if kernel_dir is None:
+        msg = f"No kernel version directories found in {modules_dir}"
+        raise FileNotFoundError(msg)
+
+    return Path(kernel_dir.path) / "kernel"
+
+
+@functools.lru_cache(maxsize=64)
+def _dir_index(directory: Path) -> dict[str, str]:
+    """List a store directory once, mapping entry names to paths.
+
+    Store paths are immutable, so the listing can be reused.
+    """
+    try:
+        with os.scandir(directory) as it:
+            return {entry.name: entry.path for entry in it}
+    except FileNotFoundError:
+        return {}
+
+
+def find_modules(
+    modules_drv: str,
+    module_patterns: Iterable[tuple[str, str]],
+) -> list[Path]:
     """Find kernel modules in the kernel modules directory.
 
     Args:
         modules_drv: Nix store path to kernel modules derivation
-        module_patterns: List of module paths relative to lib/modules/VERSION/kernel/
-                        (e.g., "drivers/virtio/virtio.ko")
+        module_patterns: (directory, file name) pairs relative to
+            lib/modules/VERSION/kernel/ (e.g., ("drivers/virtio", "virtio.ko"))
 
     Returns:
         List of module paths (dependency resolution handled by initramfs builder)
 
     """
     modules = []
-    modules_base = Path(modules_drv)
+    kernel_base = _kernel_base(modules_drv)
 
-    # Find the kernel version directory
-    modules_dir = modules_base / "lib" / "modules"
-    kernel_dirs = list(modules_dir.glob("*"))
-    if not kernel_dirs:
-        msg = f"No kernel version directories found in {modules_dir}"
-        raise FileNotFoundError(msg)
-
-    kernel_dir = kernel_dirs[0]
-    kernel_base = kernel_dir / "kernel"
-
-    for pattern in module_patterns:
+    for parent, name in module_patterns:
+        entries = _dir_index(kernel_base / parent)
         # Try with compression extensions
-        found = False
-        for ext in [".xz", ".gz", ""]:
-            module_path = Path(str(kernel_base / pattern) + ext)
-            if module_path.exists():
+        for ext in (".xz", ".gz", ""):
+            entry_path = entries.get(name + ext)
+            if entry_path is not None:
+                module_path = Path(entry_path)
                 modules.append(module_path)
                 logger.info("Found module: %s", module_path)
-                found = True
                 break
-
-        if not found:
-            msg = f"Could not find module {pattern} in {kernel_base}"
+        else:
+            msg = f"Could not find module {parent}/{name} in {kernel_base}"
             raise FileNotFoundError(msg)
 
     return modules
 
 
-def resolve_nix_packages(package_attrs: list[str]) -> str:
+@functools.cache
+def resolve_nix_packages(package_attrs: tuple[str, ...]) -> str:
     """Resolve Nix package attributes and generate a PATH string using makeBinPath.
 
+    Results are memoized for the lifetime of the process.
+
     Args:
-        package_attrs: List of package attribute names (e.g., ["busybox", "python3"])
+        package_attrs: Package attribute names (e.g., ("busybox", "python3"))
 
     Returns:
         A colon-separated PATH string containing bin directories from all packages
@@ -186,16 +382,20 @@ def resolve_nix_packages(package_attrs: list[str]) -> str:
     packages_list = " ".join(package_attrs)
     nix_expr = f"with import <nixpkgs> {{}}; lib.makeBinPath [ {packages_list} ]"
 
+    # Reuse a cached result as long as all of its directories still exist
+    key = _nixpkgs_cache_key(nix_expr)
+    cached = _get_cached_eval(key)
+    if cached is not None and all(Path(p).is_dir() for p in cached[0].split(":")):
+        bin_path = cached[0]
+        logger.info("Resolved packages %s to cached PATH: %s", package_attrs, bin_path)
+        return bin_path
+
     try:
-        result = subprocess.run(
-            ["nix", "eval", "--raw", "--impure", "--expr", nix_expr],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
+        result = run_command(["nix", "eval", "--raw", "--impure", "--expr", nix_expr])
         # nix eval --raw returns the raw string without quotes
         bin_path = result.stdout.strip()
         logger.info("Resolved packages %s to PATH: %s", package_attrs, bin_path)
+        _store_cached_eval(key, [bin_path])
         return bin_path
     except subprocess.CalledProcessError as e:
         logger.exception("Failed to resolve packages %s: %s", package_attrs, e.stderr)
@@ -245,14 +445,7 @@ def resolve_kernel_and_initramfs(
     # Find virtiofs modules
     modules = find_modules(modules_drv, VIRTIOFS_MODULES)
 
-    # Create temporary initramfs file
-    import os
-
-    fd, initramfs_tmpfile = tempfile.mkstemp(suffix=".cpio", prefix="kdf-initramfs-")
-    os.close(fd)  # Close the file descriptor, we just need the path
-    initramfs_path = Path(initramfs_tmpfile)
-
-    logger.info("Building initramfs with %d virtiofs modules", len(modules))
-    create_initramfs_archive(init_binary, initramfs_path, modules, "/init-modules")
+    logger.info("Using initramfs with %d virtiofs modules", len(modules))
+    initramfs_path = get_cached_initramfs(init_binary, modules, "/init-modules")
 
     return kernel_image, initramfs_path
@@ -0,0 +1,44 @@
+"""Subprocess helpers for kdf."""
+
+import functools
+import shutil
+import subprocess
+
+
+@functools.cache
+def find_executable(name: str) -> str:
+    """Resolve an executable name on PATH to its full path.
+
+    subprocess only uses posix_spawn (instead of fork+exec) for executables
+    given with a directory, so resolve them up front. If name is not found it
+    is returned unchanged, leaving subprocess to report the error.
+    """
+    return shutil.which(name) or name
+
+
+def run_command(
+    cmd: list[str],
+    *,
+    check: bool = True,
+) -> subprocess.CompletedProcess[str]:
+    """Run a command, capturing its output as text.
+
+    fds opened by Python are non-inheritable (PEP 446), so the close-all-fds
+    pass is skipped, which together with the resolved executable lets
+    subprocess spawn the command with posix_spawn.
+
+    Args:
+        cmd: Command and arguments
+        check: Raise CalledProcessError if the command fails
+
+    Returns:
+        The completed process
+
+    """
+    return subprocess.run(
+        [find_executable(cmd[0]), *cmd[1:]],
+        capture_output=True,
+        text=True,
+        check=check,
+        close_fds=False,
+    )
@@ -1,11 +1,12 @@
 """QEMU command building and management for kdf."""
 
 from dataclasses import dataclass, field
+from itertools import chain
 from pathlib import Path
+from typing import NamedTuple
 
 
-@dataclass
-class VirtiofsMount:
+class VirtiofsMount(NamedTuple):
     """Virtiofs mount specification (matches kdf-init)."""
 
     tag: str
@@ -13,15 +14,14 @@ class VirtiofsMount:
     with_overlay: bool
 
 
-@dataclass
-class Symlink:
+class Symlink(NamedTuple):
     """Symlink specification (matches kdf-init)."""
 
     source: str
     target: str
 
 
-@dataclass
+@dataclass(slots=True)
 class InitConfig:
     """Configuration for kdf-init (matches kdf-init/src/cmdline.rs)."""
 
@@ -34,72 +34,112 @@ class InitConfig:
     console: str = "console"
     chdir: str | None = None
 
-    def to_cmdline(self) -> list[str]:
-        """Convert init configuration to kernel cmdline parameters.
+    def freeze_prefix(self) -> tuple[str, ...]:
+        """Format the static init parameters.
+
+        These are the parameters for console, shell, script, moddir and
+        chdir, which rarely change between runs.
 
         Returns:
-            List of kernel cmdline parameters (console= and init.XXX)
+            Tuple of kernel cmdline parameters (console= and init.XXX)
 
         Raises:
-            ValueError: If both shell and command are set, or neither is set
+            ValueError: If shell is not set
 
         """
-        params = []
-
         # Validate that shell is always set (script is optional)
         if self.shell is None:
             msg = "Shell is required"
             raise ValueError(msg)
 
-        # Build console= kernel parameter (for kernel output)
-        params.append(f"console={self.console}")
+        return _static_cmdline(
+            self.console, self.shell, self.script, self.moddir, self.chdir
+        )
 
-        # Build init.console parameter (required, for init to open the console device)
-        # Note: Pass just the device name; init will prepend /dev/ when opening
-        params.append(f"init.console={self.console}")
+    def to_cmdline(self) -> list[str]:
+        """Convert init configuration to kernel cmdline parameters.
+
+        kdf-init looks parameters up by key, so the static prefix goes first
+        regardless of the original parameter order.
+
+        Returns:
+            List of kernel cmdline parameters (console= and init.XXX)
+
+        Raises:
+            ValueError: If shell is not set
+
+        """
+        params = list(self.freeze_prefix())
 
         # Build init.virtiofs parameter
         if self.virtiofs_mounts:
-            specs = []
-            for mount in self.virtiofs_mounts:
-                if mount.with_overlay:
-                    specs.append(f"{mount.tag}:{mount.path}:Y")
-                else:
-                    specs.append(f"{mount.tag}:{mount.path}")
-            params.append(f"init.virtiofs={','.join(specs)}")
+            specs = ",".join(
+                f"{mount.tag}:{mount.path}:Y"
+                if mount.with_overlay
+                else f"{mount.tag}:{mount.path}"
+                for mount in self.virtiofs_mounts
+            )
+            params.append(f"init.virtiofs={specs}")
 
         # Build init.symlinks parameter
         if self.symlinks:
-            specs = [f"{sym.source}:{sym.target}" for sym in self.symlinks]
-            params.append(f"init.symlinks={','.join(specs)}")
+            specs = ",".join(f"{sym.source}:{sym.target}" for sym in self.symlinks)
+            params.append(f"init.symlinks={specs}")
 
         # Build init.env.XXX parameters
-        for key, value in self.env_vars.items():
-            params.append(f"init.env.{key}={value}")
+        params.extend(f"init.env.{key}={value}" for key, value in self.env_vars.items())
 
-        # Build init.shell parameter (required)
-        # Wrap in backticks to preserve spaces
-        params.append(f"init.shell=`{self.shell}`")
+        return params
 
-        # Build init.script parameter (optional)
-        if self.script is not None:
-            # Wrap in backticks to preserve spaces
-            params.append(f"init.script=`{self.script}`")
 
-        # Build init.moddir parameter
-        if self.moddir:
-            params.append(f"init.moddir={self.moddir}")
+def _static_cmdline(
+    console: str,
+    shell: str,
+    script: str | None,
+    moddir: str | None,
+    chdir: str | None,
+) -> tuple[str, ...]:
+    """Format the static init parameters (see InitConfig.freeze_prefix)."""
+    # Build console= kernel parameter (for kernel output)
+    params = [f"console={console}"]
 
-        # Build init.chdir parameter
-        if self.chdir:
-            params.append(f"init.chdir={self.chdir}")
+    # Build init.console parameter (required, for init to open the console device)
+    # Note: Pass just the device name; init will prepend /dev/ when opening
+    params.append(f"init.console={console}")
 
-        return params
+    # Build init.shell parameter (required)
+    # Wrap in backticks to preserve spaces
+    params.append(f"init.shell=`{shell}`")
+
+    # Build init.script parameter (optional)
+    if script is not None:
+        # Wrap in backticks to preserve spaces
+        params.append(f"init.script=`{script}`")
+
+    # Build init.moddir parameter
+    if moddir:
+        params.append(f"init.moddir={moddir}")
+
+    # Build init.chdir parameter
+    if chdir:
+        params.append(f"init.chdir={chdir}")
+
+    return tuple(params)
 
 
 class QemuCommand:
     """Builder for QEMU command arguments."""
 
+    __slots__ = (
+        "cmdline_parts",
+        "debug",
+        "init_config",
+        "initramfs",
+        "kernel",
+        "memory",
+        "qemu_args",
+    )
+
     def __init__(
         self,
         kernel: Path,
@@ -183,8 +223,9 @@ class QemuCommand:
         # Add configured QEMU args (includes memory configuration)
         cmd.extend(self.qemu_args)
 
-        # Build complete kernel cmdline (base + init config)
-        cmdline = self.cmdline_parts + self.init_config.to_cmdline()
-        cmd.extend(["-append", " ".join(cmdline)])
+        # Build complete kernel cmdline (base + init config). Not cached, since
+        # init_config is mutated directly by callers.
+        cmdline = " ".join(chain(self.cmdline_parts, self.init_config.to_cmdline()))
+        cmd.extend(("-append", cmdline))
 
         return cmd
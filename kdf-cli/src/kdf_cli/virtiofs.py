@@ -1,13 +1,23 @@
 """Virtiofs daemon management for kdf."""
 
+import contextlib
+import ctypes
 import logging
+import os
+import re
+import select
+import selectors
+import signal
+import stat
+import struct
 import subprocess
 import threading
 import time
 from pathlib import Path
-from typing import IO, TYPE_CHECKING
+from typing import TYPE_CHECKING
 
 from kdf_cli.bg_tasks import BackgroundTask, BackgroundTaskManager
+from kdf_cli.process import find_executable
 
 if TYPE_CHECKING:
     from kdf_cli.qemu import QemuCommand
@@ -27,9 +37,155 @@ class VirtiofsSocketError(VirtiofsError):
     """Socket creation failed."""
 
 
+# inotify(7) constants
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+_INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+# How long to wait for virtiofsd to create its socket
+SOCKET_TIMEOUT = 5.0
+
+# How long to wait for virtiofsd to exit after SIGTERM before killing it
+STOP_TIMEOUT = 2.0
+
+# Virtiofs share spec: tag:host_path:guest_path[:overlay][:cache]
+_SPEC_RE = re.compile(
+    r"([^:]+):([^:]+):([^:]+)(?::(overlay)?(?::(none|auto|always))?)?",
+)
+
+
+def _stat(path: Path, *, follow_symlinks: bool = True) -> os.stat_result | None:
+    """Stat path, returning None if it does not exist."""
+    try:
+        return path.stat(follow_symlinks=follow_symlinks)
+    except FileNotFoundError:
+        return None
+
+
+class Inotify:
+    """Minimal inotify watch on a single directory (via libc)."""
+
+    def __init__(self, path: Path, mask: int) -> None:
+        """Create an inotify instance watching path.
+
+        Args:
+            path: Directory to watch
+            mask: inotify event mask (e.g. IN_CREATE)
+
+        Raises:
+            OSError: If inotify is unavailable or the watch cannot be added
+
+        """
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno))
+
+    def fileno(self) -> int:
+        """Return the inotify file descriptor (for select/poll)."""
+        return self.fd
+
+    def read_names(self) -> list[str]:
+        """Read pending events and return the file names they refer to."""
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset < len(data):
+            _wd, _mask, _cookie, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            names.append(os.fsdecode(data[offset : offset + length].rstrip(b"\0")))
+            offset += length
+        return names
+
+    def close(self) -> None:
+        """Close the inotify file descriptor."""
+        os.close(self.fd)
+
+
+class _VirtiofsLogPump:
+    """Log the output of all virtiofsd processes from a single thread."""
+
+    def __init__(self) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.thread: threading.Thread | None = None
+        self.lock = threading.Lock()
+
+    def register(self, fd: int, tag: str, stream: str) -> None:
+        """Log lines read from a pipe until it reaches EOF.
+
+        Args:
+            fd: Read end of the pipe (owned by the pump and closed on EOF)
+            tag: Virtiofs tag of the daemon writing to the pipe
+            stream: Stream name for log messages (e.g. "stdout")
+
+        """
+        os.set_blocking(fd, False)
+        data = (tag, stream, bytearray())
+        self.selector.register(fd, selectors.EVENT_READ, data)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            for key, _ in self.selector.select():
+                self._read(key)
+
+    def _read(self, key: selectors.SelectorKey) -> None:
+        tag, stream, buf = key.data
+        try:
+            data = os.read(key.fd, 65536)
+        except BlockingIOError:
+            return
+
+        buf += data
+        *lines, rest = buf.split(b"\n")
+        if not data and rest:
+            # EOF: flush a trailing partial line
+            lines.append(rest)
+        for line in lines:
+            logger.info(
+                "[virtiofsd:%s] %s: %s",
+                tag,
+                stream,
+                line.decode("utf-8", "replace").rstrip(),
+            )
+        buf[:] = rest
+
+        if not data:
+            self.selector.unregister(key.fd)
+            os.close(key.fd)
+
+
+_log_pump = _VirtiofsLogPump()
+
+
 class Virtiofsd(BackgroundTask):
     """Manage a single virtiofsd daemon instance."""
 
+    __slots__ = (
+        "_cmd",
+        "cache_mode",
+        "device_id",
+        "guest_path",
+        "host_path",
+        "pidfd",
+        "proc",
+        "socket_path",
+        "tag",
+        "with_overlay",
+    )
+
     def __init__(
         self,
         tag: str,
@@ -60,7 +216,22 @@ class Virtiofsd(BackgroundTask):
         self.socket_path = runtime_dir / f"{tag}.sock"
         self.device_id = device_id
         self.proc = None
-        self.log_thread = None
+        self.pidfd = None
+
+        # Cache mode: none=no caching (see all host changes immediately),
+        #             auto=metadata caching (default),
+        #             always=full caching (best performance)
+        self._cmd = [
+            find_executable("virtiofsd"),
+            "--socket-path",
+            str(self.socket_path),
+            "--shared-dir",
+            str(self.host_path),
+            "--sandbox",
+            "none",
+            "--cache",
+            self.cache_mode,
+        ]
 
     def start(self) -> None:
         """Start the virtiofsd daemon.
@@ -70,12 +241,23 @@ class Virtiofsd(BackgroundTask):
             VirtiofsSocketError: If socket already exists or creation fails
 
         """
-        if not self.host_path.exists():
+        start_virtiofsd_daemons([self], self.socket_path.parent)
+
+    def check_paths(self) -> None:
+        """Check that the daemon can be started.
+
+        Raises:
+            VirtiofsPathError: If host path does not exist
+            VirtiofsSocketError: If socket already exists
+
+        """
+        if _stat(self.host_path) is None:
             msg = f"Host path does not exist: {self.host_path}"
             raise VirtiofsPathError(msg)
 
         # Check for existing socket - fail if present (indicates running daemon)
-        if self.socket_path.exists():
+        socket_stat = _stat(self.socket_path, follow_symlinks=False)
+        if socket_stat is not None and stat.S_ISSOCK(socket_stat.st_mode):
             msg = (
                 f"Socket already exists for tag '{self.tag}': {self.socket_path}. "
                 "Another virtiofsd may be running or socket was not cleaned up."
@@ -83,82 +265,88 @@ class Virtiofsd(BackgroundTask):
             raise VirtiofsSocketError(
                 msg,
             )
+        if socket_stat is not None:
+            msg = f"Socket path exists and is not a socket: {self.socket_path}"
+            raise VirtiofsSocketError(msg)
 
-        # Build command
-        # Cache mode: none=no caching (see all host changes immediately),
-        #             auto=metadata caching (default),
-        #             always=full caching (best performance)
-        cmd = [
-            "virtiofsd",
-            "--socket-path",
-            str(self.socket_path),
-            "--shared-dir",
-            str(self.host_path),
-            "--sandbox",
-            "none",
-            "--cache",
-            self.cache_mode,
-        ]
-
+    def spawn(self) -> None:
+        """Spawn the virtiofsd process without waiting for its socket."""
         logger.info(
             "Starting virtiofsd for tag '%s' sharing %s", self.tag, self.host_path
         )
-        logger.info("Command: %s", " ".join(cmd))
-
-        self.proc = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,  # Line buffered
-        )
-
-        # Start thread to read and log virtiofsd output
-        def log_output(pipe: IO[str], prefix: str) -> None:
-            for line in pipe:
-                logger.info("[virtiofsd:%s] %s: %s", self.tag, prefix, line.rstrip())
-
-        self.log_thread_stdout = threading.Thread(
-            target=log_output,
-            args=(self.proc.stdout, "stdout"),
-            daemon=True,
-        )
-        self.log_thread_stderr = threading.Thread(
-            target=log_output,
-            args=(self.proc.stderr, "stderr"),
-            daemon=True,
-        )
-        self.log_thread_stdout.start()
-        self.log_thread_stderr.start()
-
-        # Wait for socket to be created
-        for _ in range(50):  # Wait up to 5 seconds
-            if self.socket_path.exists():
-                break
-            time.sleep(0.1)
-        else:
-            self.stop()
-            msg = f"Failed to create socket: {self.socket_path}"
-            raise VirtiofsSocketError(msg)
+        logger.info("Command: %s", " ".join(self._cmd))
+
+        # subprocess only uses posix_spawn (vfork, no close-all-fds loop) for
+        # an executable path with a directory, close_fds=False, no cwd,
+        # preexec_fn, pass_fds or session/group/user changes, and no std
+        # streams redirected onto fds 0-2. Our own fds are non-inheritable
+        # (PEP 446), so close_fds=False leaks nothing. stdin is /dev/null so
+        # the daemon cannot read from the terminal QEMU uses for its console.
+        #
+        # The pipes are created directly rather than with subprocess.PIPE, as
+        # the log pump reads the raw fds and never needs file objects. Only
+        # the read ends are made non-blocking; virtiofsd writes blocking.
+        stdout_r, stdout_w = os.pipe2(os.O_CLOEXEC)
+        stderr_r, stderr_w = os.pipe2(os.O_CLOEXEC)
+        try:
+            self.proc = subprocess.Popen(
+                self._cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=stdout_w,
+                stderr=stderr_w,
+                close_fds=False,
+            )
+        except BaseException:
+            os.close(stdout_r)
+            os.close(stderr_r)
+            raise
+        finally:
+            os.close(stdout_w)
+            os.close(stderr_w)
+
+        # A pidfd refers to this process even after its pid is reused, and
+        # becomes readable when it exits
+        try:
+            self.pidfd = os.pidfd_open(self.proc.pid)
+        except (AttributeError, OSError):
+            # pidfds need Linux 5.3; stopping falls back to Popen.wait
+            self.pidfd = None
+
+        # Log virtiofsd output from the shared log pump thread
+        _log_pump.register(stdout_r, self.tag, "stdout")
+        _log_pump.register(stderr_r, self.tag, "stderr")
+
+    def has_exited(self) -> bool:
+        """Return True if the virtiofsd process has exited."""
+        return self.proc is not None and self.proc.poll() is not None
+
+    def send_signal(self, sig: int) -> None:
+        """Send a signal to the virtiofsd process if it is still running."""
+        if self.pidfd is None:
+            if self.proc is not None:
+                self.proc.send_signal(sig)
+            return
+        with contextlib.suppress(ProcessLookupError):
+            signal.pidfd_send_signal(self.pidfd, sig)
 
     def stop(self) -> None:
         """Stop the virtiofsd daemon."""
-        if self.proc and self.proc.poll() is None:
-            logger.info("Stopping virtiofsd for tag '%s'", self.tag)
-            self.proc.terminate()
-            try:
-                self.proc.wait(timeout=2)
-            except subprocess.TimeoutExpired:
-                logger.warning(
-                    "virtiofsd for tag '%s' did not terminate, killing",
-                    self.tag,
-                )
-                self.proc.kill()
-                self.proc.wait()
+        stop_virtiofsd_daemons([self])
+
+    def reap(self) -> None:
+        """Wait for the signalled virtiofsd process and clean up after it."""
+        if self.proc is not None:
+            self.proc.wait()
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
 
         # Cleanup socket file
-        if self.socket_path.exists():
+        try:
             self.socket_path.unlink()
+        except FileNotFoundError:
+            pass
+        else:
             logger.info("Cleaned up socket: %s", self.socket_path)
 
     def register_with_qemu(self, qemu_cmd: "QemuCommand") -> None:
@@ -188,6 +376,191 @@ class Virtiofsd(BackgroundTask):
         qemu_cmd.init_config.virtiofs_mounts.append(mount)
 
 
+def _wait_for_sockets(
+    daemons: list[Virtiofsd],
+    watch: Inotify | None,
+    timeout: float,
+) -> list[Virtiofsd]:
+    """Wait for all daemons to create their sockets.
+
+    Args:
+        daemons: Spawned daemons, all with sockets in the watched directory
+        watch: inotify watch on the socket directory, or None to poll
+        timeout: Maximum time to wait in seconds
+
+    Returns:
+        Daemons whose socket did not appear (timed out or virtiofsd exited)
+
+    """
+    deadline = time.monotonic() + timeout
+    pending = {d.socket_path.name: d for d in daemons if not d.socket_path.exists()}
+    # poll() rather than select(), which breaks on fds above FD_SETSIZE
+    poller = select.poll()
+    if watch is not None:
+        poller.register(watch, select.POLLIN)
+    # pidfds become readable when a daemon exits, so the wait also ends early
+    # if a daemon dies before creating its socket
+    for daemon in pending.values():
+        if daemon.pidfd is not None:
+            poller.register(daemon.pidfd, select.POLLIN)
+    # Socket creation and daemon exits that wake no fd must be polled for
+    can_block = watch is not None and all(d.pidfd is not None for d in pending.values())
+
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or any(d.has_exited() for d in pending.values()):
+            break
+        # One wait covers every pending socket and daemon
+        poller.poll((remaining if can_block else min(0.1, remaining)) * 1000)
+        if watch is None:
+            created = [name for name, d in pending.items() if d.socket_path.exists()]
+        else:
+            created = watch.read_names()
+        for name in created:
+            daemon = pending.pop(name, None)
+            # Stop watching daemons that are up, so their exit cannot wake us
+            if daemon is not None and daemon.pidfd is not None:
+                poller.unregister(daemon.pidfd)
+    return list(pending.values())
+
+
+def start_virtiofsd_daemons(daemons: list[Virtiofsd], runtime_dir: Path) -> None:
+    """Start virtiofsd daemons concurrently and wait for all of their sockets.
+
+    All daemons are spawned before waiting, so startup takes as long as the
+    slowest daemon rather than the sum of all of them.
+
+    Args:
+        daemons: Daemons to start, with sockets in runtime_dir
+        runtime_dir: Directory containing the daemon sockets
+
+    Raises:
+        VirtiofsPathError: If a host path does not exist
+        VirtiofsSocketError: If a socket already exists or creation fails
+
+    """
+    for daemon in daemons:
+        daemon.check_paths()
+
+    # Watch for sockets before spawning so their creation cannot be missed
+    try:
+        # Sockets are created in place, but also catch ones renamed into place
+        watch = Inotify(runtime_dir, IN_CREATE | IN_MOVED_TO)
+    except (OSError, AttributeError) as e:
+        logger.debug("inotify unavailable, polling for sockets: %s", e)
+        watch = None
+
+    try:
+        for daemon in daemons:
+            daemon.spawn()
+        failed = _wait_for_sockets(daemons, watch, SOCKET_TIMEOUT)
+    finally:
+        if watch is not None:
+            watch.close()
+
+    if failed:
+        stop_virtiofsd_daemons(daemons)
+        sockets = ", ".join(str(d.socket_path) for d in failed)
+        msg = f"Failed to create socket: {sockets}"
+        raise VirtiofsSocketError(msg)
+
+
+def _wait_for_exit(daemons: list[Virtiofsd], timeout: float) -> list[Virtiofsd]:
+    """Wait for signalled daemons to exit.
+
+    Args:
+        daemons: Running daemons
+        timeout: Maximum time to wait in seconds
+
+    Returns:
+        Daemons that were still running when the timeout expired
+
+    """
+    deadline = time.monotonic() + timeout
+
+    # One poll() covers the pidfds of all daemons
+    poller = select.poll()
+    pending = {}
+    for daemon in daemons:
+        if daemon.pidfd is not None:
+            poller.register(daemon.pidfd, select.POLLIN)
+            pending[daemon.pidfd] = daemon
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        for fd, _ in poller.poll(remaining * 1000):
+            poller.unregister(fd)
+            del pending[fd]
+    still_running = list(pending.values())
+
+    # Without pidfds, wait on each process in turn
+    for daemon in daemons:
+        if daemon.pidfd is None and daemon.proc is not None:
+            try:
+                daemon.proc.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                still_running.append(daemon)
+    return still_running
+
+
+def stop_virtiofsd_daemons(daemons: list[Virtiofsd]) -> None:
+    """Stop virtiofsd daemons, waiting for all of them at once.
+
+    Every daemon is sent SIGTERM before waiting, so stopping takes as long as
+    the slowest daemon. Daemons still running after STOP_TIMEOUT are killed.
+
+    Args:
+        daemons: Daemons to stop (daemons that never started are only
+            cleaned up)
+
+    """
+    running = [d for d in daemons if d.proc is not None and d.proc.poll() is None]
+    for daemon in running:
+        logger.info("Stopping virtiofsd for tag '%s'", daemon.tag)
+        daemon.send_signal(signal.SIGTERM)
+
+    for daemon in _wait_for_exit(running, STOP_TIMEOUT):
+        logger.warning("virtiofsd for tag '%s' did not terminate, killing", daemon.tag)
+        daemon.send_signal(signal.SIGKILL)
+
+    for daemon in daemons:
+        daemon.reap()
+
+
+class VirtiofsdGroup(BackgroundTask):
+    """Manage a set of virtiofsd daemons that are started together."""
+
+    def __init__(self, daemons: list[Virtiofsd], runtime_dir: Path) -> None:
+        """Initialize the daemon group.
+
+        Args:
+            daemons: Daemons to manage, with sockets in runtime_dir
+            runtime_dir: Directory for runtime files (sockets)
+
+        """
+        self.daemons = daemons
+        self.runtime_dir = runtime_dir
+
+    def start(self) -> None:
+        """Start all daemons concurrently."""
+        start_virtiofsd_daemons(self.daemons, self.runtime_dir)
+
+    def stop(self) -> None:
+        """Stop all daemons."""
+        stop_virtiofsd_daemons(self.daemons)
+
+    def register_with_qemu(self, qemu_cmd: "QemuCommand") -> None:
+        """Register all daemons with QEMU.
+
+        Args:
+            qemu_cmd: QemuCommand instance to configure
+
+        """
+        for daemon in self.daemons:
+            daemon.register_with_qemu(qemu_cmd)
+
+
 def create_virtiofs_tasks(
     virtiofs_specs: list[str],
     task_manager: BackgroundTaskManager,
@@ -212,49 +585,32 @@ def create_virtiofs_tasks(
     runtime_dir = Path("/tmp/kdf-virtiofsd")
     runtime_dir.mkdir(exist_ok=True)
 
+    daemons = []
     for idx, share_spec in enumerate(virtiofs_specs):
         # Parse share_spec: tag:host_path:guest_path[:overlay][:cache]
-        parts = share_spec.split(":")
-        if len(parts) < 3:
+        match = _SPEC_RE.fullmatch(share_spec)
+        if match is None:
             msg = (
                 f"Invalid virtiofs spec '{share_spec}': "
-                "must be tag:host_path:guest_path[:overlay][:cache]"
-            )
-            raise ValueError(
-                msg,
+                "must be tag:host_path:guest_path[:overlay][:cache] where "
+                "overlay is empty or 'overlay' and cache is none/auto/always"
             )
+            raise ValueError(msg)
 
-        tag = parts[0]
-        host_path = parts[1]
-        guest_path = parts[2]
-
-        # Parse optional overlay (4th field - empty string or "overlay")
-        with_overlay = False
-        if len(parts) > 3:
-            if parts[3] == "overlay":
-                with_overlay = True
-            elif parts[3] != "":
-                msg = (
-                    f"Invalid virtiofs spec '{share_spec}': "
-                    f"fourth field must be empty or 'overlay', got '{parts[3]}'"
-                )
-                raise ValueError(msg)
-
-        # Parse optional cache mode (5th field)
-        cache_mode = "auto"
-        if len(parts) > 4:
-            if parts[4] in ("none", "auto", "always"):
-                cache_mode = parts[4]
-            else:
-                msg = (
-                    f"Invalid virtiofs spec '{share_spec}': "
-                    f"fifth field must be cache mode (none/auto/always), "
-                    f"got '{parts[4]}'"
-                )
-                raise ValueError(msg)
-
-        # Create virtiofsd task
+        tag, host_path, guest_path, overlay, cache = match.groups()
+        with_overlay = overlay == "overlay"
+        cache_mode = cache or "auto"
+
+        # Tags name the sockets, so they must be unique
+        if any(daemon.tag == tag for daemon in daemons):
+            msg = f"Invalid virtiofs spec '{share_spec}': duplicate tag '{tag}'"
+            raise ValueError(msg)
+
+        # Create virtiofsd daemon
         vfsd = Virtiofsd(
             tag, host_path, guest_path, with_overlay, runtime_dir, idx, cache_mode
         )
-        task_manager.add_task(vfsd)
+        daemons.append(vfsd)
+
+    # Start all daemons as one task so they come up concurrently
+    task_manager.add_task(VirtiofsdGroup(daemons, runtime_dir))
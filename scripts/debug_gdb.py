@@ -7,6 +7,7 @@ This script connects to a QEMU VM and loads kernel module symbols dynamically
 import argparse
 import os
 import sys
+import tempfile
 from pathlib import Path
 
 
@@ -41,8 +42,9 @@ def main():
     # Build paths from vmlinux directory
     vmlinux_dir = Path(args.vmlinux_dir)
     vmlinux_path = vmlinux_dir / "vmlinux"
-    source_dir = vmlinux_dir / "lib/modules" / args.kernel_version / "source"
-    build_dir = vmlinux_dir / "lib/modules" / args.kernel_version / "build"
+    modules_dir = vmlinux_dir / "lib/modules" / args.kernel_version
+    source_dir = modules_dir / "source"
+    build_dir = modules_dir / "build"
     vmlinux_gdb = build_dir / "vmlinux-gdb.py"
 
     # Validate paths
@@ -50,46 +52,61 @@ def main():
         print(f"Error: vmlinux not found at {vmlinux_path}", file=sys.stderr)
         sys.exit(1)
 
-    if not source_dir.exists():
+    # List the modules directory once for both source and build (usually
+    # symlinks, so is_dir() still follows them)
+    try:
+        with os.scandir(modules_dir) as it:
+            entries = {entry.name: entry for entry in it}
+    except FileNotFoundError:
+        entries = {}
+
+    if "source" not in entries or not entries["source"].is_dir():
         print(f"Error: source directory not found at {source_dir}", file=sys.stderr)
         sys.exit(1)
 
-    if not build_dir.exists():
+    if "build" not in entries or not entries["build"].is_dir():
         print(f"Error: build directory not found at {build_dir}", file=sys.stderr)
         sys.exit(1)
 
-    # Build GDB command
-    gdb_args = ["gdb"]
+    # Build GDB commands
+    commands = []
 
     # Add source directories for kernel
-    gdb_args.extend(["-ex", f"dir {source_dir}/scripts"])
+    commands.append(f"dir {source_dir}/scripts")
 
     # Add source directories for modules
     for module_dir in args.module_dirs:
         module_path = Path(module_dir)
         if module_path.exists():
             print(f"Adding module source directory: {module_dir}")
-            gdb_args.extend(["-ex", f"dir {module_dir}"])
+            commands.append(f"dir {module_dir}")
         else:
             print(f"Warning: Module directory '{module_dir}' does not exist", file=sys.stderr)
 
     # Load vmlinux
-    gdb_args.extend(["-ex", f"file {vmlinux_path}"])
+    commands.append(f"file {vmlinux_path}")
 
     # Source kernel GDB scripts if available
     if vmlinux_gdb.exists():
-        gdb_args.extend(["-ex", f"source {vmlinux_gdb}"])
+        commands.append(f"source {vmlinux_gdb}")
     else:
         print(f"Warning: vmlinux-gdb.py not found at {vmlinux_gdb}", file=sys.stderr)
 
     # Create symbol loading alias if module directories provided
     if args.module_dirs:
         symbols_dirs = " ".join(args.module_dirs)
-        gdb_args.extend(["-ex", f"alias lx-symbols-runtime = lx-symbols {symbols_dirs}"])
+        commands.append(f"alias lx-symbols-runtime = lx-symbols {symbols_dirs}")
         print("Use 'lx-symbols-runtime' in GDB to load module symbols from runtime directories")
 
+    # Pass the setup commands as one command file rather than an -ex per
+    # command. GDB replaces this process, so the file is not deleted.
+    with tempfile.NamedTemporaryFile(
+        "w", prefix="kdf-gdb-", suffix=".gdb", delete=False
+    ) as f:
+        f.write("".join(f"{command}\n" for command in commands))
+
     # Connect to remote target
-    gdb_args.extend(["-ex", f"target remote localhost:{args.port}"])
+    gdb_args = ["gdb", "-x", f.name, "-ex", f"target remote localhost:{args.port}"]
 
     # Launch GDB
     os.execvp("gdb", gdb_args)